@@ -1,13 +1,31 @@
 import ebooklib
 from ebooklib import epub
-from bs4 import BeautifulSoup
+from lxml import etree
+import html
+import logging
 import os
+import posixpath
 import re
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin, urlparse
 from .models import Book, Chapter
 
+logger = logging.getLogger(__name__)
+
+# Top-level rules that would clash with the application's own styles
+_CONFLICTING_RULE_RE = re.compile(r'(?:body|html|\.container|\.navbar)\s*\{[^}]*\}', re.IGNORECASE)
+# Class/ID selectors and bare element selectors to scope under .epub-content
+_CLASS_ID_SELECTOR_RE = re.compile(r'([.#][a-zA-Z][a-zA-Z0-9_-]*)\s*{')
+_ELEMENT_SELECTOR_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9]*)\s*{', re.MULTILINE)
+# Fragment part of a link target
+_ANCHOR_RE = re.compile(r'#.*$')
+# Document names that indicate non-chapter content (matched on lower-cased names)
+_NON_CHAPTER_NAME_RE = re.compile(r'cover|title|copyright|toc')
+# Characters not allowed in extracted image filenames
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\-_.]')
+
 def parse_epub(book_instance):
-    """Parse EPUB file and create chapters"""
+    """Parse EPUB file and create chapters, returning the parsed book or None on failure"""
     try:
         epub_book = epub.read_epub(book_instance.file.path)
         
@@ -28,204 +46,297 @@ def parse_epub(book_instance):
         book_instance.save()
         
         # Clear existing chapters
-        book_instance.chapters.all().delete()
+        Chapter.objects.filter(book=book_instance).delete()
         
-        # Create images directory for this book
-        book_images_dir = f'media/book_images/{book_instance.id}'
-        os.makedirs(book_images_dir, exist_ok=True)
+        # Create the images and CSS directories for this book once, up front
+        os.makedirs(f'media/book_images/{book_instance.id}', exist_ok=True)
+        os.makedirs(f'media/book_css/{book_instance.id}', exist_ok=True)
+        
+        # Sort the manifest in a single pass; documents are processed once
+        # images and styles are in place
+        image_items = []
+        style_items = []
+        document_items = []
+        for item in epub_book.get_items():
+            item_type = item.get_type()
+            if item_type == ebooklib.ITEM_IMAGE:
+                image_items.append(item)
+            elif item_type == ebooklib.ITEM_STYLE:
+                style_items.append(item)
+            elif item_type == ebooklib.ITEM_DOCUMENT:
+                document_items.append(item)
         
         # Extract and store images
-        image_map = extract_images(epub_book, book_instance.id)
+        image_map = extract_images(image_items, book_instance.id)
+        image_basename_index = build_image_basename_index(image_map)
         
         # Extract CSS styles
-        css_styles = extract_css_styles(epub_book, book_instance.id)
+        css_styles = extract_css_styles(style_items, book_instance.id)
         
-        # Build a mapping of internal references to chapter IDs
-        internal_refs = {}
-        chapter_order = 0
-        for item in epub_book.get_items():
-            if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                # Skip cover pages and other non-chapter content
-                item_name = item.get_name().lower()
-                print(f"Processing document: {item_name}")
-                if any(skip in item_name for skip in ['cover', 'title', 'copyright', 'toc']):
-                    print(f"Skipping {item_name} - appears to be non-chapter content")
+        # Chapter documents are parsed and rewritten independently of each
+        # other, so spread that work over a thread pool; lxml drops the GIL
+        # while parsing and serializing
+        chapter_items = []
+        for item in document_items:
+            # Skip cover pages and other non-chapter content
+            item_name = item.get_name().lower()
+            logger.debug("Processing document: %s", item_name)
+            if _NON_CHAPTER_NAME_RE.search(item_name):
+                logger.debug("Skipping %s - appears to be non-chapter content", item_name)
+                continue
+            chapter_items.append(item)
+        
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            # First pass: pick out the chapters and create them in bulk so
+            # their IDs are known before any links are rewritten
+            prepared = executor.map(
+                lambda item: _prepare_chapter(item, image_map, image_basename_index, book_instance.id),
+                chapter_items
+            )
+            
+            pending_chapters = []
+            chapter_order = 0
+            for item, result in zip(chapter_items, prepared):
+                if result is None:
                     continue
-                
-                soup = BeautifulSoup(item.get_content(), 'html.parser')
-                
-                # Get chapter title
-                title = "Chapter"
-                if soup.title:
-                    title = soup.title.string
-                elif soup.find('h1'):
-                    title = soup.find('h1').get_text()
-                elif soup.find('h2'):
-                    title = soup.find('h2').get_text()
-                else:
+                title, body = result
+                if not title:
                     title = f"Chapter {chapter_order + 1}"
                 
                 # Skip if this appears to be a non-content page
                 if len(title.strip()) < 3 or title.lower() in ['cover', 'title page', 'copyright']:
                     continue
                 
-                # Update image references in content
-                update_image_references(soup, image_map, book_instance.id)
-                
-                # Update internal links to point to Django chapter URLs
-                update_internal_links(soup, book_instance.id, internal_refs)
-                
-                # Process chapter content with CSS styles
-                content = process_chapter_content(soup, css_styles)
-                
-                # Only create chapter if there's meaningful content
-                if len(content.strip()) > 100:  # Minimum content length
-                    chapter = Chapter.objects.create(
-                        book=book_instance,
-                        title=title,
-                        content=content,
-                        order=chapter_order
-                    )
-                    
-                    # Store mapping for internal references
-                    item_name = item.get_name()
-                    internal_refs[item_name] = chapter.id
-                    internal_refs[os.path.basename(item_name)] = chapter.id
-                    
-                    chapter_order += 1
+                chapter = Chapter(
+                    book=book_instance,
+                    title=title,
+                    content='',
+                    order=chapter_order
+                )
+                pending_chapters.append((chapter, item.get_name(), body))
+                chapter_order += 1
+            
+            chapters = [chapter for chapter, _, _ in pending_chapters]
+            Chapter.objects.bulk_create(chapters, batch_size=200)
+            
+            # Build a mapping of internal references to chapter IDs
+            internal_refs = {}
+            for chapter, item_name, _ in pending_chapters:
+                internal_refs[item_name] = chapter.id
+                # Normalized key for links that differ in case
+                internal_refs.setdefault(item_name.lower(), chapter.id)
+            
+            # Bare file names come last and the first chapter with a given
+            # name wins, so they never shadow a full manifest path
+            for chapter, item_name, _ in pending_chapters:
+                basename = os.path.basename(item_name)
+                internal_refs.setdefault(basename, chapter.id)
+                internal_refs.setdefault(basename.lower(), chapter.id)
+            
+            # Second pass: rewrite links now that every chapter is known
+            contents = executor.map(
+                lambda pending: _render_chapter(pending[2], pending[1], internal_refs, css_styles, book_instance.id),
+                pending_chapters
+            )
+            for chapter, content in zip(chapters, contents):
+                chapter.content = content
+        
+        Chapter.objects.bulk_update(chapters, ['content'], batch_size=200)
         
-        return True
+        return epub_book
     except Exception as e:
-        print(f"Error parsing EPUB: {e}")
-        return False
+        logger.error("Error parsing EPUB: %s", e)
+        return None
 
-def extract_images(epub_book, book_id):
-    """Extract images from EPUB and return a mapping of original paths to new paths"""
+def _prepare_chapter(item, image_map, basename_index, book_id):
+    """Parse a chapter document and rewrite its images, returning (title, body) or None"""
+    tree = etree.HTML(item.get_content())
+    if tree is None:
+        return None
+    
+    # Get chapter title from the first title/h1/h2 in the document
+    headings = tree.xpath('(//title|//h1|//h2)[1]')
+    title = ''.join(headings[0].itertext()).strip() if headings else ''
+    
+    # Update image references in content
+    update_image_references(tree, image_map, book_id, basename_index)
+    
+    # Only create chapter if there's any content; short pages like part titles,
+    # epigraphs and poems are real chapters and may be link targets
+    body = tree.find('body')
+    if body is None:
+        body = tree
+    has_text = any(text.strip() for text in body.itertext())
+    if not has_text and body.find('.//img') is None:
+        return None
+    
+    return title, body
+
+def _render_chapter(body, item_name, internal_refs, css_styles, book_id):
+    """Rewrite the links of a parsed chapter body and return its stored content"""
+    # Update internal links to point to Django chapter URLs
+    update_internal_links(body, book_id, internal_refs, item_name)
+    
+    # Process chapter content with CSS styles
+    return process_chapter_content(serialize_inner_html(body), css_styles, book_id)
+
+def extract_images(image_items, book_id):
+    """Extract image items from EPUB and return a mapping of original paths to new paths
+    
+    Images are written to media/book_images/<book_id>, which must already exist.
+    """
     image_map = {}
     book_images_dir = f'media/book_images/{book_id}'
     
-    for item in epub_book.get_items():
-        if item.get_type() == ebooklib.ITEM_IMAGE:
-            try:
-                # Get the original path
-                original_path = item.get_name()
-                
-                # Create a safe filename
-                filename = os.path.basename(original_path)
-                safe_filename = re.sub(r'[^\w\-_.]', '_', filename)
-                
-                # Save the image
-                new_path = f'{book_images_dir}/{safe_filename}'
-                with open(new_path, 'wb') as f:
-                    f.write(item.get_content())
-                
-                # Map original path to new path
-                image_map[original_path] = f'/media/book_images/{book_id}/{safe_filename}'
-                
-            except Exception as e:
-                print(f"Error extracting image {original_path}: {e}")
+    for item in image_items:
+        try:
+            # Get the original path
+            original_path = item.get_name()
+            
+            # Create a safe filename
+            filename = os.path.basename(original_path)
+            safe_filename = _UNSAFE_FILENAME_RE.sub('_', filename)
+            
+            # Save the image. read_epub has already loaded every manifest item
+            # into memory, so the payload is written as is rather than
+            # streamed from the archive, which would only decompress it again
+            new_path = f'{book_images_dir}/{safe_filename}'
+            with open(new_path, 'wb') as f:
+                f.write(item.get_content())
+            
+            # Map original path to new path
+            image_map[original_path] = f'/media/book_images/{book_id}/{safe_filename}'
+            
+        except Exception as e:
+            logger.warning("Error extracting image %s: %s", original_path, e)
     
     return image_map
 
-def update_image_references(soup, image_map, book_id):
+def build_image_basename_index(image_map):
+    """Map image basenames to their new paths, first occurrence wins"""
+    basename_index = {}
+    for original_path, new_path in image_map.items():
+        basename_index.setdefault(os.path.basename(original_path), new_path)
+    return basename_index
+
+def _replace_with_text(element, text=''):
+    """Remove element from its tree, leaving text and the element's tail in its place"""
+    parent = element.getparent()
+    if parent is None:
+        return
+    text = text + (element.tail or '')
+    previous = element.getprevious()
+    if previous is not None:
+        previous.tail = (previous.tail or '') + text
+    else:
+        parent.text = (parent.text or '') + text
+    parent.remove(element)
+
+def _normalize_src(src):
+    """Strip whitespace, leading './' and '../' segments and any URL parameters from an image src"""
+    src = src.strip()
+    query_start = src.find('?')
+    if query_start >= 0:
+        src = src[:query_start]
+    while src.startswith(('./', '../')):
+        src = src[2:] if src.startswith('./') else src[3:]
+    return src
+
+def update_image_references(tree, image_map, book_id, basename_index=None):
     """Update image src attributes in the HTML content"""
-    for img in soup.find_all('img'):
+    if basename_index is None:
+        basename_index = build_image_basename_index(image_map)
+    
+    missing_images = []
+    for img in tree.iter('img'):
         src = img.get('src')
         if src:
-            # Normalize the path
-            src = src.strip()
-            
-            # Handle relative paths
-            if src.startswith('../'):
-                src = src[3:]  # Remove '../'
-            elif src.startswith('./'):
-                src = src[2:]  # Remove './'
+            src = _normalize_src(src)
             
-            # Remove any URL parameters
-            if '?' in src:
-                src = src.split('?')[0]
+            # Check if we have this image in our map, by full path or basename
+            new_path = image_map.get(src) or basename_index.get(os.path.basename(src))
+            if new_path is None:
+                # Fall back to a partial path match
+                for original_path, candidate in image_map.items():
+                    if src in original_path or original_path.endswith(src):
+                        new_path = candidate
+                        break
             
-            # Check if we have this image in our map
-            if src in image_map:
-                img['src'] = image_map[src]
+            if new_path:
+                img.set('src', new_path)
             else:
-                # Try to find the image with different path variations
-                found = False
-                for original_path, new_path in image_map.items():
-                    # Try exact match
-                    if src == original_path:
-                        img['src'] = new_path
-                        found = True
-                        break
-                    # Try basename match
-                    elif os.path.basename(src) == os.path.basename(original_path):
-                        img['src'] = new_path
-                        found = True
-                        break
-                    # Try partial path match
-                    elif src in original_path or original_path.endswith(src):
-                        img['src'] = new_path
-                        found = True
-                        break
-                
-                if not found:
-                    print(f"Could not find image: {src}")
-                    # Remove the image if we can't find it
-                    img.decompose()
+                logger.debug("Could not find image: %s", src)
+                missing_images.append(img)
+    
+    # Remove the images we can't find once the tree walk is done
+    for img in missing_images:
+        _replace_with_text(img)
 
-def update_internal_links(soup, book_id, internal_refs):
+def _find_internal_ref(target_file, internal_refs, item_name=None):
+    """Look up a link target in internal_refs, retrying with normalized keys
+    
+    Relative targets are resolved against item_name, the manifest name of the
+    linking document, before trying the raw target and finally the file name
+    alone.
+    """
+    candidates = []
+    if item_name:
+        resolved = posixpath.normpath(posixpath.join(posixpath.dirname(item_name), target_file))
+        candidates += [resolved, resolved.lower()]
+    candidates += [target_file, target_file.lower(), posixpath.basename(target_file).lower()]
+    
+    for candidate in candidates:
+        chapter_id = internal_refs.get(candidate)
+        if chapter_id is not None:
+            return chapter_id
+    return None
+
+def update_internal_links(tree, book_id, internal_refs, item_name=None):
     """Update internal links in the HTML content to point to Django chapter URLs"""
+    unmatched_links = []
     # Find all links
-    for link in soup.find_all('a'):
+    for link in tree.iter('a'):
         href = link.get('href')
         if href:
             # Handle internal links (links to other parts of the EPUB)
             if href.startswith('#'):
                 # Anchor links - remove them but keep text
-                link_text = link.get_text()
-                link.replace_with(link_text)
-            elif href.endswith('.xhtml') or href.endswith('.html'):
-                # Internal file links - try to map to chapter
-                target_file = href.split('#')[0] if '#' in href else href
-                if target_file in internal_refs:
-                    # Found matching chapter, update link
-                    chapter_id = internal_refs[target_file]
-                    link['href'] = f'/book/{book_id}/chapter/{chapter_id}/'
-                else:
-                    # No matching chapter, remove link but keep text
-                    link_text = link.get_text()
-                    link.replace_with(link_text)
+                unmatched_links.append(link)
             elif href.startswith('http'):
                 # External links - keep them as is
                 continue
             else:
-                # Other internal links - try to find match
-                if href in internal_refs:
-                    chapter_id = internal_refs[href]
-                    link['href'] = f'/book/{book_id}/chapter/{chapter_id}/'
+                # Internal file links - try to map to chapter
+                target_file = _ANCHOR_RE.sub('', href)
+                chapter_id = _find_internal_ref(target_file, internal_refs, item_name)
+                if chapter_id is not None:
+                    # Found matching chapter, update link
+                    link.set('href', f'/book/{book_id}/chapter/{chapter_id}/')
                 else:
-                    # No match found, remove link but keep text
-                    link_text = link.get_text()
-                    link.replace_with(link_text)
+                    # No matching chapter, remove link but keep text
+                    unmatched_links.append(link)
+    
+    for link in unmatched_links:
+        _replace_with_text(link, ''.join(link.itertext()))
 
-def extract_css_styles(epub_book, book_id):
-    """Extract CSS styles from EPUB and return combined CSS"""
-    css_content = []
+def extract_css_styles(style_items, book_id):
+    """Extract CSS from EPUB style items and return combined CSS
     
-    # Create CSS directory for this book
+    The combined stylesheet is written to media/book_css/<book_id>, which must
+    already exist.
+    """
+    css_content = []
     css_dir = f'media/book_css/{book_id}'
-    os.makedirs(css_dir, exist_ok=True)
     
-    for item in epub_book.get_items():
-        if item.get_type() == ebooklib.ITEM_STYLE:
-            try:
-                css_text = item.get_content().decode('utf-8')
-                # Sanitize CSS to prevent conflicts
-                css_text = sanitize_css(css_text)
-                css_content.append(css_text)
-                print(f"Extracted CSS from: {item.get_name()}")
-            except Exception as e:
-                print(f"Error extracting CSS from {item.get_name()}: {e}")
+    for item in style_items:
+        try:
+            css_text = item.get_content().decode('utf-8')
+            # Sanitize CSS to prevent conflicts
+            css_text = sanitize_css(css_text)
+            css_content.append(css_text)
+            logger.debug("Extracted CSS from: %s", item.get_name())
+        except Exception as e:
+            logger.warning("Error extracting CSS from %s: %s", item.get_name(), e)
     
     # Combine all CSS
     combined_css = '\n'.join(css_content)
@@ -235,93 +346,44 @@ def extract_css_styles(epub_book, book_id):
         css_file_path = f'{css_dir}/styles.css'
         with open(css_file_path, 'w', encoding='utf-8') as f:
             f.write(combined_css)
-        print(f"Saved combined CSS to: {css_file_path}")
+        logger.debug("Saved combined CSS to: %s", css_file_path)
     
     return combined_css
 
 def sanitize_css(css_text):
     """Sanitize CSS to prevent conflicts with application styles"""
     # Remove any potentially conflicting styles
-    css_text = re.sub(r'body\s*\{[^}]*\}', '', css_text, flags=re.IGNORECASE)
-    css_text = re.sub(r'html\s*\{[^}]*\}', '', css_text, flags=re.IGNORECASE)
-    css_text = re.sub(r'\.container\s*\{[^}]*\}', '', css_text, flags=re.IGNORECASE)
-    css_text = re.sub(r'\.navbar\s*\{[^}]*\}', '', css_text, flags=re.IGNORECASE)
+    css_text = _CONFLICTING_RULE_RE.sub('', css_text)
     
     # Add book-specific prefix to prevent conflicts
-    css_text = re.sub(r'([.#][a-zA-Z][a-zA-Z0-9_-]*)\s*{', r'.epub-content \1 {', css_text)
+    css_text = _CLASS_ID_SELECTOR_RE.sub(r'.epub-content \1 {', css_text)
     
     # Also prefix general element selectors
-    css_text = re.sub(r'^([a-zA-Z][a-zA-Z0-9]*)\s*{', r'.epub-content \1 {', css_text, flags=re.MULTILINE)
+    css_text = _ELEMENT_SELECTOR_RE.sub(r'.epub-content \1 {', css_text)
     
     return css_text
 
-def process_chapter_content(soup, css_styles):
-    """Process chapter content and include CSS styles"""
-    # Get the body content
-    body_content = str(soup.body) if soup.body else str(soup)
+def serialize_inner_html(element):
+    """Serialize the children of an lxml element, without the element's own tag"""
+    parts = [html.escape(element.text, quote=False)] if element.text else []
+    parts.extend(etree.tostring(child, method='html', encoding='unicode') for child in element)
+    return ''.join(parts)
+
+def process_chapter_content(body_html, css_styles, book_id):
+    """Wrap serialized chapter body HTML and link the book's CSS styles"""
+    # The shared .epub-content rules live in static/css/epub-content.css;
+    # the book's own stylesheet is written once by extract_css_styles
+    stylesheet_link = ''
+    if css_styles:
+        stylesheet_link = f'<link rel="stylesheet" href="/media/book_css/{book_id}/styles.css"/>'
     
-    # Create a new HTML structure with CSS
-    html_content = f"""
-    <div class="epub-content">
-        <style>
-        /* EPUB Original Styles */
-        {css_styles}
-        
-        /* Additional styling for better integration */
-        .epub-content {{
-            font-family: inherit;
-            line-height: 1.6;
-        }}
-        
-        .epub-content p {{
-            margin-bottom: 1rem;
-        }}
-        
-        .epub-content img {{
-            max-width: 100%;
-            height: auto;
-            margin: 1rem 0;
-            border-radius: 4px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }}
-        
-        .epub-content h1, .epub-content h2, .epub-content h3, 
-        .epub-content h4, .epub-content h5, .epub-content h6 {{
-            margin-top: 2rem;
-            margin-bottom: 1rem;
-            font-weight: 600;
-        }}
-        
-        .epub-content blockquote {{
-            border-left: 4px solid #007bff;
-            padding-left: 1rem;
-            margin: 1rem 0;
-            font-style: italic;
-        }}
-        
-        .epub-content code {{
-            background-color: #f8f9fa;
-            padding: 0.2rem 0.4rem;
-            border-radius: 3px;
-            font-family: monospace;
-        }}
-        
-        .epub-content pre {{
-            background-color: #f8f9fa;
-            padding: 1rem;
-            border-radius: 4px;
-            overflow-x: auto;
-        }}
-        </style>
-        {body_content}
-    </div>
-    """
-    return html_content
+    return f'<div class="epub-content">{stylesheet_link}{body_html}</div>'
 
-def extract_cover_image(book_instance):
-    """Extract cover image from EPUB if available"""
+def extract_cover_image(book_instance, epub_book=None):
+    """Extract cover image from EPUB if available, reusing an already parsed book if given"""
     try:
-        epub_book = epub.read_epub(book_instance.file.path)
+        if epub_book is None:
+            epub_book = epub.read_epub(book_instance.file.path)
         
         # Create covers directory if it doesn't exist
         covers_dir = 'media/covers'
@@ -337,9 +399,9 @@ def extract_cover_image(book_instance):
                     f.write(item.get_content())
                 book_instance.cover_image = cover_path
                 book_instance.save()
-                print(f"Cover image extracted: {cover_path}")
+                logger.info("Cover image extracted: %s", cover_path)
                 break
         else:
-            print("No cover image found in EPUB")
+            logger.info("No cover image found in EPUB")
     except Exception as e:
-        print(f"Error extracting cover: {e}")
+        logger.error("Error extracting cover: %s", e)
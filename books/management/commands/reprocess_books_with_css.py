@@ -1,11 +1,22 @@
 from django.core.management.base import BaseCommand
+from django.utils import timezone
 from books.models import Book, Chapter
-from books.epub_parser import extract_css_styles, process_chapter_content, update_image_references, update_internal_links
+from books.epub_parser import extract_css_styles, process_chapter_content, serialize_inner_html, update_image_references, update_internal_links
 import ebooklib
 from ebooklib import epub
-from bs4 import BeautifulSoup
+from lxml import html as lxml_html
+import functools
 import os
 
+@functools.lru_cache(maxsize=64)
+def _load_book_css(book_id):
+    """Read a book's extracted stylesheet, or return '' if it has none"""
+    css_file = f'media/book_css/{book_id}/styles.css'
+    if os.path.exists(css_file):
+        with open(css_file, 'r', encoding='utf-8') as f:
+            return f.read()
+    return ''
+
 class Command(BaseCommand):
     help = 'Reprocess existing books to apply CSS styling'
 
@@ -57,7 +68,8 @@ class Command(BaseCommand):
                 epub_book = epub.read_epub(book.file.path)
                 
                 # Extract CSS
-                css_styles = extract_css_styles(epub_book, book.id)
+                os.makedirs(css_dir, exist_ok=True)
+                css_styles = extract_css_styles(epub_book.get_items_of_type(ebooklib.ITEM_STYLE), book.id)
                 self.stdout.write(f'Extracted {len(css_styles)} characters of CSS')
                 
                 # Reprocess all chapters with CSS
@@ -79,35 +91,35 @@ class Command(BaseCommand):
         
         # If CSS styles not provided, try to load from file
         if css_styles is None:
-            css_file = f'media/book_css/{book.id}/styles.css'
-            if os.path.exists(css_file):
-                with open(css_file, 'r', encoding='utf-8') as f:
-                    css_styles = f.read()
-            else:
-                css_styles = ''
+            css_styles = _load_book_css(book.id)
         
+        updated_chapters = []
+        # bulk_update skips auto_now, so stamp the edit time explicitly
+        now = timezone.now()
         for chapter in chapters:
             try:
-                # Parse existing chapter content to get the original HTML
-                soup = BeautifulSoup(chapter.content, 'html.parser')
+                # Parse existing chapter content once to get the original HTML
+                tree = lxml_html.document_fromstring(chapter.content)
                 
                 # If content already has epub-content wrapper, extract the original content
-                epub_content_div = soup.find('div', class_='epub-content')
-                if epub_content_div:
-                    # Remove style tag and get the inner content
-                    style_tag = epub_content_div.find('style')
-                    if style_tag:
-                        style_tag.decompose()
-                    # Get the content without the wrapper
-                    inner_content = ''.join(str(child) for child in epub_content_div.children)
-                    soup = BeautifulSoup(inner_content, 'html.parser')
+                content_root = tree.find(".//div[@class='epub-content']")
+                if content_root is not None:
+                    # Remove the inline style block or stylesheet link, keeping any text after it
+                    for tag in content_root.xpath('./style|./link'):
+                        tag.drop_tree()
+                else:
+                    content_root = tree.find('body')
+                    if content_root is None:
+                        content_root = tree
                 
-                # Apply new CSS processing
-                new_content = process_chapter_content(soup, css_styles)
+                # Apply new CSS processing to the content without the wrapper
+                new_content = process_chapter_content(serialize_inner_html(content_root), css_styles, book.id)
                 
-                # Update chapter
+                # Update chapter and drop its cached PDF text; changes are written in one batch below
                 chapter.content = new_content
-                chapter.save()
+                chapter.plain_text = None
+                chapter.updated_at = now
+                updated_chapters.append(chapter)
                 
                 self.stdout.write(f'  ✓ Updated chapter: {chapter.title}')
                 
@@ -116,5 +128,7 @@ class Command(BaseCommand):
                     self.style.WARNING(f'  ✗ Error updating chapter {chapter.title}: {str(e)}')
                 )
         
+        Chapter.objects.bulk_update(updated_chapters, ['content', 'plain_text', 'updated_at'], batch_size=200)
+        
         self.stdout.write(f'Finished reprocessing chapters for: {book.title}')
 
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-14 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0002_book_last_chapter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='plain_text',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
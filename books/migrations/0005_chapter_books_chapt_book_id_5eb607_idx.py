@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-14 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0004_chapter_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chapter',
+            index=models.Index(fields=['book', 'order'], name='books_chapt_book_id_5eb607_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.5 on 2026-10-14 15:00
+
+from django.db import migrations, models
+
+
+def reset_empty_plain_text(apps, schema_editor):
+    # Empty text used to also mean "not computed"; recompute it once
+    Chapter = apps.get_model('books', 'Chapter')
+    Chapter.objects.filter(plain_text='').update(plain_text=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0005_chapter_books_chapt_book_id_5eb607_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chapter',
+            name='plain_text',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.RunPython(reset_empty_plain_text, migrations.RunPython.noop),
+    ]
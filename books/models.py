@@ -1,5 +1,6 @@
 from django.db import models
 import os
+import shutil
 
 # Create your models here.
 
@@ -19,27 +20,26 @@ class Book(models.Model):
         return os.path.basename(self.file.name)
     
     def delete(self, *args, **kwargs):
-        # Delete the file from filesystem when the model is deleted
-        if self.file:
-            if os.path.isfile(self.file.path):
-                os.remove(self.file.path)
-        if self.cover_image:
-            if os.path.isfile(self.cover_image.path):
-                os.remove(self.cover_image.path)
-        
-        # Delete extracted images directory
+        # Collect filesystem paths first; the instance loses its id once deleted
+        file_path = self.file.path if self.file else None
+        cover_path = self.cover_image.path if self.cover_image else None
         book_images_dir = f'media/book_images/{self.id}'
-        if os.path.exists(book_images_dir):
-            import shutil
-            shutil.rmtree(book_images_dir)
-        
-        # Delete extracted CSS directory
         book_css_dir = f'media/book_css/{self.id}'
-        if os.path.exists(book_css_dir):
-            import shutil
-            shutil.rmtree(book_css_dir)
         
-        super().delete(*args, **kwargs)
+        # Let the ORM cascade to chapters, then remove files only once the rows are gone
+        result = super().delete(*args, **kwargs)
+        
+        # Delete the file from filesystem when the model is deleted
+        for path in (file_path, cover_path):
+            if path and os.path.isfile(path):
+                os.remove(path)
+        
+        # Delete extracted images and CSS directories
+        for directory in (book_images_dir, book_css_dir):
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+        
+        return result
     
     class Meta:
         ordering = ['-uploaded_at']
@@ -48,10 +48,13 @@ class Chapter(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='chapters')
     title = models.CharField(max_length=200)
     content = models.TextField()
+    plain_text = models.TextField(null=True, blank=True)  # Cleaned text cache for PDF generation; NULL until computed
     order = models.IntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['order']
+        indexes = [models.Index(fields=['book', 'order'])]
     
     def __str__(self):
         return f"{self.book.title} - {self.title}"
@@ -1,8 +1,13 @@
+import multiprocessing
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import tempfile
 import re
 from django.conf import settings
-from django.http import HttpResponse
+from django.db.models import Max
+from django.http import FileResponse
 from reportlab.lib.pagesizes import A4, letter
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
@@ -13,8 +18,35 @@ from reportlab.pdfgen import canvas
 from reportlab.lib.fonts import addMapping
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from bs4 import BeautifulSoup
 from .models import Book, Chapter
+from .text_extraction import extract_and_clean, extract_text_content
+
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\-_.]')
+
+# Shared pool for chapter text extraction, started on first use
+_EXTRACTION_POOL = None
+_EXTRACTION_POOL_LOCK = threading.Lock()
+
+def _get_extraction_pool():
+    """Return the shared text extraction pool, creating it if needed"""
+    global _EXTRACTION_POOL
+    with _EXTRACTION_POOL_LOCK:
+        if _EXTRACTION_POOL is None:
+            # Spawn rather than fork the (possibly threaded) server; workers only
+            # import books.text_extraction, which does not need Django set up
+            _EXTRACTION_POOL = ProcessPoolExecutor(
+                max_workers=min(4, os.cpu_count() or 1),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _EXTRACTION_POOL
+
+def _reset_extraction_pool(pool):
+    """Drop a broken pool so the next PDF starts a fresh one"""
+    global _EXTRACTION_POOL
+    with _EXTRACTION_POOL_LOCK:
+        if _EXTRACTION_POOL is pool:
+            _EXTRACTION_POOL = None
+    pool.shutdown(wait=False)
 
 class PDFGenerator:
     """Service class for generating PDFs from EPUB content"""
@@ -96,6 +128,12 @@ class PDFGenerator:
         # Create PDF file
         pdf_path = self._create_pdf_path(format_type, quality)
         
+        # Reuse a previously generated PDF if no chapter changed since it was written
+        if os.path.exists(pdf_path):
+            last_updated = chapters.aggregate(last_updated=Max('updated_at'))['last_updated']
+            if last_updated and os.path.getmtime(pdf_path) > last_updated.timestamp():
+                return pdf_path
+        
         # Generate PDF content
         self._generate_pdf_content(pdf_path, chapters, format_type, quality)
         
@@ -103,9 +141,10 @@ class PDFGenerator:
     
     def _create_pdf_path(self, format_type, quality):
         """Create PDF file path"""
-        # Create safe filename
-        safe_title = re.sub(r'[^\w\-_.]', '_', self.book.title)
-        pdf_filename = f"{safe_title}_{format_type}_{quality}.pdf"
+        # Create safe filename; the book id keeps books with the same title from
+        # sharing (and reusing) each other's cached PDF
+        safe_title = _UNSAFE_FILENAME_RE.sub('_', self.book.title)
+        pdf_filename = f"{safe_title}_{self.book.id}_{format_type}_{quality}.pdf"
         
         # Create PDF directory if it doesn't exist
         pdf_dir = os.path.join(settings.MEDIA_ROOT, 'pdfs')
@@ -142,6 +181,10 @@ class PDFGenerator:
         story.extend(self._create_title_page())
         story.append(PageBreak())
         
+        # Extract text for chapters without a cached copy across worker processes
+        chapters = list(chapters)
+        self._fill_plain_text(chapters)
+        
         # Chapters (skip table of contents)
         for i, chapter in enumerate(chapters, 1):
             story.extend(self._create_chapter_content(chapter, i, format_type))
@@ -151,6 +194,29 @@ class PDFGenerator:
         # Build PDF with page numbering
         doc.build(story, onFirstPage=self._add_page_number, onLaterPages=self._add_page_number)
     
+    def _fill_plain_text(self, chapters):
+        """Extract and cache cleaned text for chapters that do not have it yet"""
+        # NULL means the text was never extracted; an empty string is a cached result
+        pending = [chapter for chapter in chapters if chapter.plain_text is None]
+        if not pending:
+            return
+        
+        args = [(chapter.content, chapter.title) for chapter in pending]
+        cleaned = None
+        if len(pending) > 1:
+            pool = _get_extraction_pool()
+            try:
+                cleaned = list(pool.map(extract_and_clean, args))
+            except BrokenProcessPool:
+                # Fall back to extracting in this process
+                _reset_extraction_pool(pool)
+        if cleaned is None:
+            cleaned = [extract_and_clean(arg) for arg in args]
+        
+        for chapter, plain_text in zip(pending, cleaned):
+            chapter.plain_text = plain_text
+        Chapter.objects.bulk_update(pending, ['plain_text'], batch_size=200)
+    
     def _create_title_page(self):
         """Create title page content"""
         story = []
@@ -194,271 +260,22 @@ class PDFGenerator:
         chapter_title = chapter.title
         story.append(Paragraph(chapter_title, self.chapter_title_style))
         
-        # Chapter content (remove the chapter title from content to avoid duplication)
-        content = self._extract_text_content(chapter.content, chapter_title)
-        paragraphs = content.split('\n\n')
+        # Chapter content, cleaned ahead of time by _fill_plain_text
+        plain_text = chapter.plain_text
         
         # Choose style based on format
         body_style = self.mobile_body_style if format_type == 'mobile' else self.body_style
         
-        for paragraph in paragraphs:
-            paragraph = paragraph.strip()
+        for paragraph in plain_text.split('\n\n'):
             if paragraph:
-                # Clean up paragraph text
-                paragraph = self._clean_text(paragraph)
-                if paragraph:
-                    story.append(Paragraph(paragraph, body_style))
-                    story.append(Spacer(1, 5))
+                story.append(Paragraph(paragraph, body_style))
+                story.append(Spacer(1, 5))
         
         return story
     
     def _extract_text_content(self, html_content, chapter_title=None):
-        """Extract plain text from HTML content using BeautifulSoup"""
-        try:
-            # Parse HTML with BeautifulSoup
-            soup = BeautifulSoup(html_content, 'html.parser')
-            
-            # Remove all style and script tags
-            for tag in soup(['style', 'script']):
-                tag.decompose()
-            
-            # Remove the epub-content wrapper div if present
-            epub_content = soup.find('div', class_='epub-content')
-            if epub_content:
-                soup = epub_content
-            
-            # Get text content
-            text = soup.get_text()
-            
-            # Clean up the text
-            lines = text.split('\n')
-            cleaned_lines = []
-            
-            for line in lines:
-                line = line.strip()
-                # Only include lines with substantial content
-                if line and len(line) > 5 and re.search(r'[a-zA-Z]', line):
-                    # Clean up whitespace
-                    line = re.sub(r'\s+', ' ', line).strip()
-                    cleaned_lines.append(line)
-            
-            # Join lines into paragraphs
-            result = '\n\n'.join(cleaned_lines)
-            
-            # Remove chapter title from content if provided to avoid duplication
-            if chapter_title and result:
-                # Try to remove the chapter title from the beginning of the content
-                title_patterns = [
-                    chapter_title,
-                    chapter_title.strip(),
-                    chapter_title.upper(),
-                    chapter_title.lower(),
-                    chapter_title.title(),
-                ]
-                
-                for pattern in title_patterns:
-                    if result.startswith(pattern):
-                        result = result[len(pattern):].strip()
-                        break
-                
-                # Also try to remove it if it appears as a separate paragraph
-                paragraphs = result.split('\n\n')
-                filtered_paragraphs = []
-                for para in paragraphs:
-                    para_stripped = para.strip()
-                    # Skip paragraphs that match the chapter title
-                    if para_stripped and not any(para_stripped == pattern for pattern in title_patterns):
-                        filtered_paragraphs.append(para)
-                
-                result = '\n\n'.join(filtered_paragraphs)
-            
-            # If we got very little content, try a more aggressive approach
-            if len(result.strip()) < 100:
-                return self._extract_text_content_aggressive(html_content, chapter_title)
-            
-            return result
-            
-        except Exception as e:
-            # Fallback to regex-based extraction if BeautifulSoup fails
-            return self._extract_text_content_fallback(html_content, chapter_title)
-    
-    def _extract_text_content_aggressive(self, html_content, chapter_title=None):
-        """More aggressive text extraction for complex EPUB content"""
-        # Remove all style and script content first
-        html_content = re.sub(r'<style[^>]*>.*?</style>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        html_content = re.sub(r'<script[^>]*>.*?</script>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        
-        # Remove CSS comments
-        html_content = re.sub(r'/\*.*?\*/', '', html_content, flags=re.DOTALL)
-        
-        # Remove the epub-content wrapper div if present
-        if '<div class="epub-content">' in html_content:
-            start = html_content.find('<div class="epub-content">') + len('<div class="epub-content">')
-            end = html_content.find('</div>', start)
-            if end != -1:
-                html_content = html_content[start:end].strip()
-        
-        # Remove all HTML tags
-        html_content = re.sub(r'<[^>]+>', '', html_content)
-        
-        # Handle HTML entities
-        html_content = html_content.replace('&nbsp;', ' ')
-        html_content = html_content.replace('&amp;', '&')
-        html_content = html_content.replace('&lt;', '<')
-        html_content = html_content.replace('&gt;', '>')
-        html_content = html_content.replace('&quot;', '"')
-        html_content = html_content.replace('&#39;', "'")
-        html_content = html_content.replace('&ldquo;', '"')
-        html_content = html_content.replace('&rdquo;', '"')
-        html_content = html_content.replace('&lsquo;', "'")
-        html_content = html_content.replace('&rsquo;', "'")
-        html_content = html_content.replace('&mdash;', '—')
-        html_content = html_content.replace('&ndash;', '–')
-        
-        # Clean up whitespace and split into lines
-        lines = html_content.split('\n')
-        cleaned_lines = []
-        
-        for line in lines:
-            line = line.strip()
-            # Only include lines with substantial content
-            if line and len(line) > 5 and re.search(r'[a-zA-Z]', line):
-                # Clean up whitespace
-                line = re.sub(r'\s+', ' ', line).strip()
-                cleaned_lines.append(line)
-        
-        result = '\n\n'.join(cleaned_lines)
-        
-        # Remove chapter title from content if provided to avoid duplication
-        if chapter_title and result:
-            # Try to remove the chapter title from the beginning of the content
-            title_patterns = [
-                chapter_title,
-                chapter_title.strip(),
-                chapter_title.upper(),
-                chapter_title.lower(),
-                chapter_title.title(),
-            ]
-            
-            for pattern in title_patterns:
-                if result.startswith(pattern):
-                    result = result[len(pattern):].strip()
-                    break
-            
-            # Also try to remove it if it appears as a separate paragraph
-            paragraphs = result.split('\n\n')
-            filtered_paragraphs = []
-            for para in paragraphs:
-                para_stripped = para.strip()
-                # Skip paragraphs that match the chapter title
-                if para_stripped and not any(para_stripped == pattern for pattern in title_patterns):
-                    filtered_paragraphs.append(para)
-            
-            result = '\n\n'.join(filtered_paragraphs)
-        
-        return result
-    
-    def _extract_text_content_fallback(self, html_content, chapter_title=None):
-        """Fallback text extraction using regex"""
-        # Remove all style and script tags
-        html_content = re.sub(r'<style[^>]*>.*?</style>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        html_content = re.sub(r'<script[^>]*>.*?</script>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-        
-        # Remove the epub-content wrapper div if present
-        if '<div class="epub-content">' in html_content:
-            start = html_content.find('<div class="epub-content">') + len('<div class="epub-content">')
-            end = html_content.find('</div>', start)
-            if end != -1:
-                html_content = html_content[start:end].strip()
-        
-        # Remove all HTML tags
-        html_content = re.sub(r'<[^>]+>', '', html_content)
-        
-        # Handle HTML entities
-        html_content = html_content.replace('&nbsp;', ' ')
-        html_content = html_content.replace('&amp;', '&')
-        html_content = html_content.replace('&lt;', '<')
-        html_content = html_content.replace('&gt;', '>')
-        html_content = html_content.replace('&quot;', '"')
-        html_content = html_content.replace('&#39;', "'")
-        html_content = html_content.replace('&ldquo;', '"')
-        html_content = html_content.replace('&rdquo;', '"')
-        html_content = html_content.replace('&lsquo;', "'")
-        html_content = html_content.replace('&rsquo;', "'")
-        html_content = html_content.replace('&mdash;', '—')
-        html_content = html_content.replace('&ndash;', '–')
-        
-        # Clean up whitespace
-        lines = html_content.split('\n')
-        cleaned_lines = []
-        
-        for line in lines:
-            line = line.strip()
-            if line and len(line) > 5 and re.search(r'[a-zA-Z]', line):
-                line = re.sub(r'\s+', ' ', line).strip()
-                cleaned_lines.append(line)
-        
-        result = '\n\n'.join(cleaned_lines)
-        
-        # Remove chapter title from content if provided to avoid duplication
-        if chapter_title and result:
-            # Try to remove the chapter title from the beginning of the content
-            title_patterns = [
-                chapter_title,
-                chapter_title.strip(),
-                chapter_title.upper(),
-                chapter_title.lower(),
-                chapter_title.title(),
-            ]
-            
-            for pattern in title_patterns:
-                if result.startswith(pattern):
-                    result = result[len(pattern):].strip()
-                    break
-            
-            # Also try to remove it if it appears as a separate paragraph
-            paragraphs = result.split('\n\n')
-            filtered_paragraphs = []
-            for para in paragraphs:
-                para_stripped = para.strip()
-                # Skip paragraphs that match the chapter title
-                if para_stripped and not any(para_stripped == pattern for pattern in title_patterns):
-                    filtered_paragraphs.append(para)
-            
-            result = '\n\n'.join(filtered_paragraphs)
-        
-        return result
-    
-    def _clean_text(self, text):
-        """Clean and format text for PDF"""
-        # Remove any remaining HTML tags that might have slipped through
-        text = re.sub(r'<[^>]+>', '', text)
-        
-        # Remove extra whitespace
-        text = re.sub(r'\s+', ' ', text)
-        
-        # Handle any remaining HTML entities
-        text = text.replace('&nbsp;', ' ')
-        text = text.replace('&amp;', '&')
-        text = text.replace('&lt;', '<')
-        text = text.replace('&gt;', '>')
-        text = text.replace('&quot;', '"')
-        text = text.replace('&#39;', "'")
-        text = text.replace('&ldquo;', '"')
-        text = text.replace('&rdquo;', '"')
-        text = text.replace('&lsquo;', "'")
-        text = text.replace('&rsquo;', "'")
-        text = text.replace('&mdash;', '—')
-        text = text.replace('&ndash;', '–')
-        
-        # Remove any CSS-like content that might remain
-        text = re.sub(r'\{[^}]*\}', '', text)  # Remove CSS rules
-        text = re.sub(r'@[^{]*\{[^}]*\}', '', text)  # Remove CSS at-rules
-        
-        # Clean up any remaining whitespace
-        text = re.sub(r'\s+', ' ', text)
-        
-        return text.strip()
+        """Extract plain text from HTML content; delegates to text_extraction.extract_text_content"""
+        return extract_text_content(html_content, chapter_title)
     
     def _add_page_number(self, canvas, doc):
         """Add page number to the bottom of each page"""
@@ -511,13 +328,19 @@ class PDFGenerator:
         try:
             pdf_path = self.generate_pdf(format_type, quality)
             
-            # Read the PDF file
-            with open(pdf_path, 'rb') as pdf_file:
-                response = HttpResponse(pdf_file.read(), content_type='application/pdf')
-                response['Content-Disposition'] = f'attachment; filename="{os.path.basename(pdf_path)}"'
-                response['Content-Length'] = os.path.getsize(pdf_path)
-            
-            return response
+            # Stream the PDF file; FileResponse closes it and sets Content-Length
+            pdf_file = open(pdf_path, 'rb')
+            try:
+                return FileResponse(
+                    pdf_file,
+                    as_attachment=True,
+                    filename=os.path.basename(pdf_path),
+                    content_type='application/pdf'
+                )
+            except Exception:
+                # The response never took ownership of the handle
+                pdf_file.close()
+                raise
             
         except Exception as e:
             raise Exception(f"Error generating PDF: {str(e)}")
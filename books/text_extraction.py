@@ -0,0 +1,176 @@
+import html
+import re
+from bs4 import BeautifulSoup, FeatureNotFound
+
+# Text extraction for PDF generation. Keep this module free of Django imports:
+# spawned PDF worker processes import it without app setup.
+
+# Patterns used while turning chapter HTML into plain text
+_WS_RE = re.compile(r'\s+')
+_STYLE_SCRIPT_RE = re.compile(r'<(style|script)\b[^>]*>.*?</\1>', re.DOTALL | re.IGNORECASE)
+_CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+_TAG_RE = re.compile(r'<[^>]+>')
+_CSS_RULE_RE = re.compile(r'\{[^}]*\}')
+_CSS_AT_RULE_RE = re.compile(r'@[^{]*\{[^}]*\}')
+
+def _substantial_lines(text):
+    """Yield whitespace-collapsed lines of text that are long enough and contain a letter"""
+    for line in text.split('\n'):
+        line = _WS_RE.sub(' ', line).strip()
+        if len(line) > 5 and any(c.isalpha() for c in line):
+            yield line
+
+def _strip_title(result, chapter_title):
+    """Remove the chapter title from the start of the text and from standalone paragraphs"""
+    if not chapter_title or not result:
+        return result
+    
+    # Try to remove the chapter title from the beginning of the content
+    title_patterns = (
+        chapter_title,
+        chapter_title.strip(),
+        chapter_title.upper(),
+        chapter_title.lower(),
+        chapter_title.title(),
+    )
+    for pattern in title_patterns:
+        if result.startswith(pattern):
+            result = result[len(pattern):].strip()
+            break
+    
+    # Also remove it if it appears as a separate paragraph
+    title_set = frozenset(title_patterns)
+    return '\n\n'.join(
+        para for para in result.split('\n\n')
+        if para.strip() and para.strip() not in title_set
+    )
+
+def extract_plain_text(html_content, chapter_title=None):
+    """Extract and clean chapter text, returning paragraphs separated by blank lines"""
+    # Remove the chapter title from content to avoid duplication
+    content = extract_text_content(html_content, chapter_title)
+    
+    cleaned_paragraphs = []
+    for paragraph in content.split('\n\n'):
+        paragraph = paragraph.strip()
+        if paragraph:
+            # Clean up paragraph text
+            paragraph = _clean_text(paragraph)
+            if paragraph:
+                cleaned_paragraphs.append(paragraph)
+    
+    return '\n\n'.join(cleaned_paragraphs)
+
+def extract_text_content(html_content, chapter_title=None):
+    """Extract plain text from HTML content using BeautifulSoup"""
+    try:
+        # Parse HTML with BeautifulSoup, preferring the C-based lxml parser
+        try:
+            soup = BeautifulSoup(html_content, 'lxml')
+        except FeatureNotFound:
+            soup = BeautifulSoup(html_content, 'html.parser')
+        
+        # Remove all style and script tags
+        for tag in soup(['style', 'script']):
+            tag.decompose()
+        
+        # Remove the epub-content wrapper div if present
+        epub_content = soup.find('div', class_='epub-content')
+        if epub_content:
+            soup = epub_content
+        
+        # Get text content
+        text = soup.get_text()
+        
+        # Clean up the text and join lines into paragraphs
+        result = '\n\n'.join(_substantial_lines(text))
+        
+        # Remove chapter title from content if provided to avoid duplication
+        result = _strip_title(result, chapter_title)
+        
+        # If we got very little content, try a more aggressive approach
+        if len(result.strip()) < 100:
+            return _extract_text_content_aggressive(html_content, chapter_title)
+        
+        return result
+        
+    except Exception:
+        # Fallback to regex-based extraction if BeautifulSoup fails
+        return _extract_text_content_fallback(html_content, chapter_title)
+
+def _extract_text_content_aggressive(html_content, chapter_title=None):
+    """More aggressive text extraction for complex EPUB content"""
+    # Remove all style and script content first
+    html_content = _STYLE_SCRIPT_RE.sub('', html_content)
+    
+    # Remove CSS comments
+    html_content = _CSS_COMMENT_RE.sub('', html_content)
+    
+    # Remove the epub-content wrapper div if present
+    if '<div class="epub-content">' in html_content:
+        start = html_content.find('<div class="epub-content">') + len('<div class="epub-content">')
+        end = html_content.find('</div>', start)
+        if end != -1:
+            html_content = html_content[start:end].strip()
+    
+    # Remove all HTML tags
+    html_content = _TAG_RE.sub('', html_content)
+    
+    # Handle HTML entities
+    html_content = html.unescape(html_content)
+    
+    # Clean up whitespace and split into lines
+    result = '\n\n'.join(_substantial_lines(html_content))
+    
+    # Remove chapter title from content if provided to avoid duplication
+    result = _strip_title(result, chapter_title)
+    
+    return result
+
+def _extract_text_content_fallback(html_content, chapter_title=None):
+    """Fallback text extraction using regex"""
+    # Remove all style and script tags
+    html_content = _STYLE_SCRIPT_RE.sub('', html_content)
+    
+    # Remove the epub-content wrapper div if present
+    if '<div class="epub-content">' in html_content:
+        start = html_content.find('<div class="epub-content">') + len('<div class="epub-content">')
+        end = html_content.find('</div>', start)
+        if end != -1:
+            html_content = html_content[start:end].strip()
+    
+    # Remove all HTML tags
+    html_content = _TAG_RE.sub('', html_content)
+    
+    # Handle HTML entities
+    html_content = html.unescape(html_content)
+    
+    # Clean up whitespace
+    result = '\n\n'.join(_substantial_lines(html_content))
+    
+    # Remove chapter title from content if provided to avoid duplication
+    result = _strip_title(result, chapter_title)
+    
+    return result
+
+def _clean_text(text):
+    """Clean and format text for PDF"""
+    # Remove any remaining HTML tags that might have slipped through
+    text = _TAG_RE.sub('', text)
+    
+    # Handle any remaining HTML entities
+    text = html.unescape(text)
+    
+    # Remove any CSS-like content that might remain
+    text = _CSS_RULE_RE.sub('', text)  # Remove CSS rules
+    text = _CSS_AT_RULE_RE.sub('', text)  # Remove CSS at-rules
+    
+    # Collapse whitespace, including non-breaking spaces from decoded entities
+    text = _WS_RE.sub(' ', text)
+    
+    return text.strip()
+
+def extract_and_clean(args):
+    """Extract cleaned text for one (content, title) pair, for use with executor.map"""
+    html_content, chapter_title = args
+    return extract_plain_text(html_content, chapter_title)
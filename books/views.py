@@ -2,39 +2,52 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.views.generic import ListView, DetailView, CreateView, DeleteView
 from django.urls import reverse_lazy
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, Http404
+from django.db.models import Count, Prefetch
 from .models import Book, Chapter
 from .forms import BookUploadForm
 from .epub_parser import parse_epub, extract_cover_image
 from .pdf_generator import PDFGenerator
 
+# Chapter lists only need these columns; the content is loaded for the open chapter alone
+CHAPTER_LIST_QUERYSET = Chapter.objects.only('id', 'title', 'order', 'book')
+
 class LibraryView(ListView):
     model = Book
+    # Load the last read chapter and chapter counts with the books themselves
+    queryset = (
+        Book.objects.select_related('last_chapter')
+        .defer('last_chapter__content', 'last_chapter__plain_text')
+        .annotate(chapter_count=Count('chapters'))
+    )
     template_name = 'books/library.html'
     context_object_name = 'books'
     ordering = ['-uploaded_at']
 
 class BookReaderView(DetailView):
     model = Book
+    queryset = Book.objects.prefetch_related(Prefetch('chapters', queryset=CHAPTER_LIST_QUERYSET))
     template_name = 'books/reader.html'
     context_object_name = 'book'
     
     def get(self, request, *args, **kwargs):
         book = self.get_object()
         
+        # Resolve the redirect target from the prefetched chapter list
+        chapters = book.chapters.all()
+        
         # If user has a last read chapter, redirect to it
-        if book.last_chapter:
-            try:
-                # Verify the chapter still exists
-                chapter = Chapter.objects.get(id=book.last_chapter.id, book=book)
-                return redirect('books:chapter', book_id=book.id, chapter_id=chapter.id)
-            except Chapter.DoesNotExist:
-                # Chapter was deleted, clear the reference
-                book.last_chapter = None
-                book.save()
+        if book.last_chapter_id:
+            # Verify the chapter still exists
+            if any(chapter.id == book.last_chapter_id for chapter in chapters):
+                return redirect('books:chapter', book_id=book.id, chapter_id=book.last_chapter_id)
+            
+            # Chapter was deleted, clear the reference
+            Book.objects.filter(pk=book.pk).update(last_chapter=None)
+            book.last_chapter = None
         
         # If no last chapter or chapter doesn't exist, show the first chapter
-        first_chapter = book.chapters.first()
+        first_chapter = next(iter(chapters), None)
         if first_chapter:
             return redirect('books:chapter', book_id=book.id, chapter_id=first_chapter.id)
         
@@ -55,9 +68,10 @@ class BookUploadView(CreateView):
         response = super().form_valid(form)
         
         # Parse EPUB and create chapters
-        if parse_epub(form.instance):
-            # Try to extract cover image
-            extract_cover_image(form.instance)
+        epub_book = parse_epub(form.instance)
+        if epub_book:
+            # Try to extract cover image from the already parsed book
+            extract_cover_image(form.instance, epub_book)
             messages.success(self.request, f'Successfully uploaded and parsed "{form.instance.title}"')
         else:
             messages.error(self.request, 'Error parsing EPUB file. Please check if it\'s a valid EPUB.')
@@ -79,23 +93,31 @@ class BookDeleteView(DeleteView):
 
 def chapter_view(request, book_id, chapter_id):
     """View for individual chapters"""
-    book = get_object_or_404(Book, id=book_id)
+    book = get_object_or_404(Book.objects.prefetch_related(Prefetch('chapters', queryset=CHAPTER_LIST_QUERYSET)), id=book_id)
     chapter = get_object_or_404(Chapter, id=chapter_id, book=book)
     
     # Update the last read chapter when user visits a chapter
-    if book.last_chapter != chapter:
+    if book.last_chapter_id != chapter.id:
+        # Only these two columns change, so update them directly
+        Book.objects.filter(pk=book.pk).update(last_chapter=chapter, last_position=0)
         book.last_chapter = chapter
         book.last_position = 0  # Reset position for new chapter
-        book.save()
         print(f"Updated last read chapter for '{book.title}': '{chapter.title}'")
     
-    # Get previous and next chapters
-    prev_chapter = Chapter.objects.filter(book=book, order__lt=chapter.order).order_by('-order').first()
-    next_chapter = Chapter.objects.filter(book=book, order__gt=chapter.order).order_by('order').first()
+    # Get previous and next chapters from the prefetched, ordered chapter list
+    chapters = book.chapters.all()
+    prev_chapter = None
+    next_chapter = None
+    for candidate in chapters:
+        if candidate.order < chapter.order:
+            prev_chapter = candidate
+        elif candidate.order > chapter.order:
+            next_chapter = candidate
+            break
     
     # Check if this is the last read chapter to restore scroll position
     restore_position = False
-    if book.last_chapter and book.last_chapter.id == chapter.id:
+    if book.last_chapter_id == chapter.id:
         restore_position = True
     
     context = {
@@ -103,7 +125,7 @@ def chapter_view(request, book_id, chapter_id):
         'chapter': chapter,
         'prev_chapter': prev_chapter,
         'next_chapter': next_chapter,
-        'chapters': book.chapters.all(),
+        'chapters': chapters,
         'restore_position': restore_position,
         'last_position': book.last_position if restore_position else 0,
     }
@@ -113,20 +135,32 @@ def chapter_view(request, book_id, chapter_id):
 def update_progress(request, book_id):
     """Update reading progress via AJAX"""
     if request.method == 'POST':
-        book = get_object_or_404(Book, id=book_id)
         position = request.POST.get('position', 0)
         chapter_id = request.POST.get('chapter_id')
         
         try:
-            book.last_position = int(position)
+            updates = {'last_position': int(position)}
+            chapter_title = None
             if chapter_id:
-                chapter = get_object_or_404(Chapter, id=chapter_id, book=book)
-                book.last_chapter = chapter
-                print(f"Updated progress for book '{book.title}': Chapter '{chapter.title}', Position {position}%")
-            book.save()
-            return JsonResponse({'status': 'success', 'message': f'Progress updated: {position}% in chapter {chapter.title if chapter_id else "unknown"}'})
+                # Check the chapter belongs to this book, fetching only its title
+                chapter_title = Chapter.objects.filter(id=chapter_id, book_id=book_id).values_list('title', flat=True).first()
+                if chapter_title is None:
+                    # Tell a missing book (404, as before) apart from a chapter outside it
+                    if not Book.objects.filter(id=book_id).exists():
+                        raise Http404('No Book matches the given query.')
+                    return JsonResponse({'status': 'error', 'message': 'Chapter not found'})
+                updates['last_chapter_id'] = chapter_id
+            
+            # A single UPDATE, so concurrent progress requests cannot overwrite each other's reads
+            if not Book.objects.filter(id=book_id).update(**updates):
+                raise Http404('No Book matches the given query.')
+            if chapter_title is not None:
+                print(f"Updated progress for book {book_id}: Chapter '{chapter_title}', Position {position}%")
+            return JsonResponse({'status': 'success', 'message': f'Progress updated: {position}% in chapter {chapter_title or "unknown"}'})
         except ValueError:
             return JsonResponse({'status': 'error', 'message': 'Invalid position'})
+        except Http404:
+            raise
         except Exception as e:
             return JsonResponse({'status': 'error', 'message': str(e)})
     
@@ -134,25 +168,20 @@ def update_progress(request, book_id):
 
 def debug_progress(request):
     """Debug view to check reading progress"""
-    books = Book.objects.all()
-    debug_info = []
+    books = (
+        Book.objects.select_related('last_chapter')
+        .defer('last_chapter__content', 'last_chapter__plain_text')
+        .annotate(total_chapters=Count('chapters'))
+    )
     
+    lines = ["Reading Progress Debug Info:\n\n"]
     for book in books:
-        debug_info.append({
-            'title': book.title,
-            'last_chapter': book.last_chapter.title if book.last_chapter else 'None',
-            'last_position': book.last_position,
-            'total_chapters': book.chapters.count()
-        })
-    
-    response = "Reading Progress Debug Info:\n\n"
-    for info in debug_info:
-        response += f"Book: {info['title']}\n"
-        response += f"  Last Chapter: {info['last_chapter']}\n"
-        response += f"  Position: {info['last_position']}%\n"
-        response += f"  Total Chapters: {info['total_chapters']}\n\n"
-    
-    return HttpResponse(response, content_type='text/plain')
+        lines.append(f"Book: {book.title}\n")
+        lines.append(f"  Last Chapter: {book.last_chapter.title if book.last_chapter else 'None'}\n")
+        lines.append(f"  Position: {book.last_position}%\n")
+        lines.append(f"  Total Chapters: {book.total_chapters}\n\n")
+    
+    return HttpResponse(''.join(lines), content_type='text/plain')
 
 def generate_pdf(request, book_id):
     """Generate PDF from EPUB book"""